@@ -21,10 +21,14 @@
     'init_xml': [],
     'update_xml': [],
     'data': [
+        'security/ir.model.access.csv',
+
         'views/payment_views.xml',
         'views/payment_payzen_templates.xml',
+        'views/payzen_notification_views.xml',
 
         'data/payment_acquirer.xml',
+        'data/ir_cron.xml',
     ],
     'demo': [],
     'application': False,
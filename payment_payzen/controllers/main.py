@@ -1,6 +1,7 @@
 import werkzeug
 
 from odoo import http
+from odoo.exceptions import ValidationError
 from odoo.http import request
 
 
@@ -16,3 +17,20 @@ class PayzenController(http.Controller):
         request.env['payment.transaction'].form_feedback(kw, 'payzen')
 
         return werkzeug.utils.redirect('/')
+
+    @http.route(['/payment/payzen/ipn'], type='http', auth='public', methods=['POST'], csrf=False)
+    def payzen_ipn(self, **kw):
+        """Route called by Payzen server to server notifications (IPN)
+
+        The notification is only checked and staged here, it is applied to the transaction
+        by the `payzen.notification` cron so that Payzen is acknowledged immediately.
+
+        :param kw: dict that contains POST values received from Payzen
+        :return: response object
+        """
+        try:
+            request.env['payzen.notification'].payzen_stage_notification(kw)
+        except ValidationError:
+            return werkzeug.wrappers.Response('KO', status=400)
+
+        return 'OK'
@@ -1,3 +1,4 @@
 from . import inherited_payment_acquirer
 from . import inherited_payment_transaction
 from . import inherited_res_currency
+from . import payzen_notification
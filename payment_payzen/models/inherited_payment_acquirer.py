@@ -1,11 +1,36 @@
 import hashlib
+import logging
+import threading
 import urllib.parse
 import uuid
 from datetime import datetime
 
-from odoo import api, fields, models
+import requests
+
+from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
 from odoo.tools import float_round
 
+_logger = logging.getLogger(__name__)
+
+PAYZEN_TIMEOUT = 30
+
+_payzen_local = threading.local()
+
+
+def _get_payzen_session():
+    """Return the requests session of the current thread
+
+    Sessions are not guaranteed to be thread-safe, so each thread (HTTP worker thread, cron
+    thread) keeps its own, which still keeps connections to the Payzen web services alive
+    between calls.
+    """
+    session = getattr(_payzen_local, 'session', None)
+    if session is None:
+        session = _payzen_local.session = requests.Session()
+
+    return session
+
 
 class PayzenAcquirer(models.Model):
     _inherit = 'payment.acquirer'
@@ -20,6 +45,12 @@ class PayzenAcquirer(models.Model):
         default="https://secure.payzen.eu/vads-payment/",
         required_if_provider='payzen'
     )
+    payzen_rest_api_url = fields.Char(
+        string="REST API URL",
+        default="https://api.payzen.eu/api-payment/"
+    )
+    payzen_test_password = fields.Char(string="Test REST API password", groups='base.group_system')
+    payzen_prod_password = fields.Char(string="Prod REST API password", groups='base.group_system')
 
     @api.model
     def _get_feature_support(self):
@@ -35,6 +66,7 @@ class PayzenAcquirer(models.Model):
         """
         res = super(PayzenAcquirer, self)._get_feature_support()
         res['authorize'].append('paypal')
+        res['tokenize'].append('payzen')
         return res
 
     @api.multi
@@ -91,12 +123,13 @@ class PayzenAcquirer(models.Model):
             # Payzen requires a unique 6-digits number between 000000 and 899999 per day
             'vads_trans_id': '%.6d' % int(uuid.uuid4().int % 899999),
             'vads_ctx_mode': mode,
-            'vads_page_action': 'PAYMENT',
+            'vads_page_action': values.get('type') == 'form_save' and 'REGISTER_PAY' or 'PAYMENT',
             'vads_action_mode': 'INTERACTIVE',
             'vads_payment_config': 'SINGLE',
             'vads_version': 'V2',
             'vads_return_mode': 'GET',
             'vads_url_return': '%s' % urllib.parse.urljoin(base_url, values.get('return_url')),
+            'vads_url_check': urllib.parse.urljoin(base_url, '/payment/payzen/ipn'),
             'vads_order_id': values.get('reference').replace('/', ' '),
 
             'vads_cust_id': values.get('partner_id'),
@@ -114,3 +147,36 @@ class PayzenAcquirer(models.Model):
         payzen_tx_values['payzen_signature'] = self.payzen_generate_digital_sign(payzen_tx_values)
 
         return payzen_tx_values
+
+    @api.multi
+    def payzen_rest_call(self, service, payload):
+        """Call a service of the Payzen REST API, through the session of the current thread
+
+        :param service: name of the service, e.g. 'Charge/CreatePayment'
+        :param payload: dict sent as JSON body of the request
+        :return: decoded JSON response
+        """
+        self.ensure_one()
+
+        # Credentials are restricted to administrators, but payments may be run by any user
+        acquirer = self.sudo()
+
+        password = acquirer.payzen_test_password
+        if acquirer.environment == 'prod':
+            password = acquirer.payzen_prod_password
+
+        url = urllib.parse.urljoin(acquirer.payzen_rest_api_url, 'V4/%s' % service)
+
+        try:
+            response = _get_payzen_session().post(
+                url,
+                json=payload,
+                auth=(acquirer.payzen_shop_id, password or ''),
+                timeout=PAYZEN_TIMEOUT
+            )
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error_msg = _("Payzen: call to {} failed ({})").format(service, e)
+            _logger.info(error_msg)
+            raise ValidationError(error_msg) from e
@@ -1,8 +1,10 @@
 import logging
 
+import requests
+
 from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
-from odoo.tools.float_utils import float_compare
+from odoo.tools.float_utils import float_compare, float_round
 
 _logger = logging.getLogger(__name__)
 
@@ -79,6 +81,24 @@ VADS_AUTH_RESULT = {
     '912': _("Issuer not available"),
 }
 
+# detailedStatus returned by the REST API, mapped on payment.transaction states. Pending server to
+# server transactions are checked again by _cron_payzen_reconcile_pending until they leave these statuses.
+PAYZEN_DETAILED_STATUS = {
+    'ACCEPTED': 'done',
+    'AUTHORISED': 'done',
+    'CAPTURED': 'done',
+    'AUTHORISED_TO_VALIDATE': 'authorized',
+    'INITIAL': 'pending',
+    'PRE_AUTHORISED': 'pending',
+    'UNDER_VERIFICATION': 'pending',
+    'WAITING_AUTHORISATION': 'pending',
+    'WAITING_AUTHORISATION_TO_VALIDATE': 'pending',
+    'WAITING_FOR_PAYMENT': 'pending',
+    'ABANDONED': 'cancel',
+    'CANCELLED': 'cancel',
+    'EXPIRED': 'cancel',
+}
+
 
 class PayzenTransaction(models.Model):
     _inherit = 'payment.transaction'
@@ -172,4 +192,132 @@ class PayzenTransaction(models.Model):
             _logger.info("Validated Payzen payment for transaction %s: set as error" % self.reference)
             values['state'] = 'error'
 
+        if (self.type == 'form_save' and data.get('vads_identifier')
+                and data.get('vads_identifier_status') in ('CREATED', 'UPDATED')
+                and values['state'] in ('done', 'authorized')):
+            values['payment_token_id'] = self._payzen_get_token(data).id
+
         return self.write(values)
+
+    @api.multi
+    def _payzen_get_token(self, data):
+        """Get or create the payment.token of the alias registered by Payzen (REGISTER_PAY)
+
+        :param data: data received from payzen at the end of transaction
+        :return: payment.token record
+        """
+        self.ensure_one()
+
+        token = self.env['payment.token'].search([
+            ('acquirer_id', '=', self.acquirer_id.id),
+            ('acquirer_ref', '=', data.get('vads_identifier')),
+        ], limit=1)
+
+        if not token:
+            token = self.env['payment.token'].create({
+                'name': data.get('vads_card_number') or data.get('vads_identifier'),
+                'partner_id': self.partner_id.id,
+                'acquirer_id': self.acquirer_id.id,
+                'acquirer_ref': data.get('vads_identifier'),
+            })
+
+        return token
+
+    @api.multi
+    def payzen_s2s_do_transaction(self, **kwargs):
+        """Pay the transaction with its payment token through the Payzen REST API
+
+        :return: True if the payment is authorized, False otherwise
+        """
+        self.ensure_one()
+
+        if not self.payment_token_id:
+            error_msg = _("Payzen: no payment token for transaction {}").format(self.reference)
+            _logger.info(error_msg)
+            raise ValidationError(error_msg)
+
+        prec = self.env['decimal.precision'].precision_get('Product Price')
+
+        try:
+            response = self.acquirer_id.payzen_rest_call('Charge/CreatePayment', {
+                'amount': int(float_round(self.amount * 100, prec)),
+                'currency': self.currency_id.name,
+                'orderId': self.reference,
+                'paymentMethodToken': self.payment_token_id.acquirer_ref,
+                'formAction': 'SILENT',
+                'customer': {
+                    'reference': str(self.partner_id.id),
+                    'email': self.partner_email or '',
+                },
+            })
+        except ValidationError as e:
+            # Without an answer, Payzen may have charged the card: keep the transaction pending so that it is
+            # reconciled by _cron_payzen_reconcile_pending instead of being paid again
+            state = 'error'
+            if isinstance(e.__cause__, requests.exceptions.Timeout):
+                state = 'pending'
+
+            self.write({'state': state, 'state_message': e.name})
+            return False
+
+        return self._payzen_s2s_validate(response)
+
+    @api.model
+    def _cron_payzen_reconcile_pending(self, limit=100):
+        """Update pending server to server transactions from the order status known by Payzen
+
+        Covers deferred payments (e.g. WAITING_AUTHORISATION) and payments whose call timed out.
+        """
+        transactions = self.search([
+            ('acquirer_id.provider', '=', 'payzen'),
+            ('type', '=', 'server2server'),
+            ('state', '=', 'pending'),
+        ], limit=limit)
+
+        for transaction in transactions:
+            try:
+                response = transaction.acquirer_id.payzen_rest_call('Order/Get', {'orderId': transaction.reference})
+            except ValidationError:
+                continue
+
+            if response.get('status') == 'SUCCESS' and not (response.get('answer') or {}).get('transactions'):
+                continue
+
+            transaction._payzen_s2s_validate(response)
+
+        return True
+
+    @api.multi
+    def _payzen_s2s_validate(self, response):
+        """Set the transaction state from a Payzen REST API response
+
+        :param response: decoded JSON response of Charge/CreatePayment
+        :return: True if the payment is authorized, False otherwise
+        """
+        self.ensure_one()
+
+        answer = response.get('answer') or {}
+
+        if response.get('status') != 'SUCCESS':
+            error_msg = "Payzen: {} {}".format(answer.get('errorCode'), answer.get('errorMessage'))
+            _logger.info("Payzen payment for transaction %s failed: %s" % (self.reference, error_msg))
+            self.write({'state': 'error', 'state_message': error_msg})
+            return False
+
+        transaction = (answer.get('transactions') or [{}])[0]
+        card_details = (transaction.get('transactionDetails') or {}).get('cardDetails') or {}
+        authorization = card_details.get('authorizationResponse') or {}
+
+        values = {
+            'state': PAYZEN_DETAILED_STATUS.get(transaction.get('detailedStatus'), 'error'),
+            'state_message': VADS_AUTH_RESULT.get(authorization.get('authorizationResult')),
+            'acquirer_reference': transaction.get('uuid'),
+        }
+
+        if values['state'] in ('done', 'authorized'):
+            values['date_validate'] = fields.Datetime.now()
+
+        _logger.info("Validated Payzen payment for transaction %s: set as %s" % (self.reference, values['state']))
+        self.write(values)
+
+        return values['state'] in ('done', 'authorized')
@@ -0,0 +1,164 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
+from odoo.tools import mute_logger
+
+_logger = logging.getLogger(__name__)
+
+
+class PayzenNotification(models.Model):
+    _name = 'payzen.notification'
+    _description = "Payzen notification"
+    _order = 'id'
+
+    acquirer_id = fields.Many2one(
+        comodel_name='payment.acquirer',
+        string="Acquirer",
+        required=True,
+        ondelete='cascade'
+    )
+    reference = fields.Char(string="Reference", readonly=True, index=True)
+    trans_uuid = fields.Char(string="Payzen transaction UUID", readonly=True, index=True)
+    trans_status = fields.Char(string="Payzen transaction status", readonly=True)
+    payload = fields.Text(string="Payload", required=True, readonly=True)
+    state = fields.Selection(
+        selection=[('pending', "Pending"), ('done', "Done"), ('error', "Error")],
+        string="State",
+        default='pending',
+        required=True,
+        index=True
+    )
+    state_message = fields.Text(string="Message")
+
+    _sql_constraints = [
+        ('payzen_notification_uniq', 'unique(acquirer_id, trans_uuid, trans_status)',
+         "A notification already exists for this Payzen transaction status"),
+    ]
+
+    @api.model
+    def payzen_stage_notification(self, data):
+        """Check the signature of a notification sent by Payzen and store it for later processing
+
+        :param data: dict that contains POST values received from Payzen
+        :return: payzen.notification record (empty if a concurrent request stored the same notification)
+            or an exception
+        """
+        acquirer = self.env['payment.acquirer'].sudo().search([
+            ('provider', '=', 'payzen'),
+            ('payzen_shop_id', '=', data.get('vads_site_id')),
+        ], limit=1)
+
+        if not acquirer:
+            error_msg = _("Payzen: no acquirer found for shop {}").format(data.get('vads_site_id'))
+            _logger.info(error_msg)
+            raise ValidationError(error_msg)
+
+        if data.get('signature') != acquirer.payzen_generate_digital_sign(data):
+            error_msg = _("Payzen: signatures mismatch")
+            _logger.info(error_msg)
+            raise ValidationError(error_msg)
+
+        values = {
+            'acquirer_id': acquirer.id,
+            'reference': (data.get('vads_order_id') or '').replace(' ', '/'),
+            'trans_uuid': data.get('vads_trans_uuid'),
+            'trans_status': data.get('vads_trans_status'),
+            'payload': json.dumps(data),
+        }
+
+        if not values['trans_uuid']:
+            return self.sudo().create(values)
+
+        # Payzen retries notifications until acknowledged: keep a single row per transaction status
+        notification = self.sudo().search([
+            ('acquirer_id', '=', values['acquirer_id']),
+            ('trans_uuid', '=', values['trans_uuid']),
+            ('trans_status', '=', values['trans_status']),
+        ], limit=1)
+        if notification:
+            return notification
+
+        try:
+            with mute_logger('odoo.sql_db'), self.env.cr.savepoint():
+                return self.sudo().create(values)
+        except psycopg2.IntegrityError:
+            _logger.info("Payzen notification for transaction %s already stored" % values['trans_uuid'])
+            return self.browse()
+
+    @api.model
+    def _cron_process_notifications(self, limit=500):
+        """Apply pending notifications to their transactions, in batches of `limit` records
+
+        Each notification is processed in its own savepoint so that a bad one does not
+        roll back the rest of the batch.
+        """
+        notifications = self.search([('state', '=', 'pending')], limit=limit)
+
+        for notification in notifications:
+            if notification._payzen_is_already_applied():
+                notification.write({
+                    'state': 'done',
+                    'state_message': _("Transaction already in a final state, notification skipped"),
+                })
+                continue
+
+            try:
+                with self.env.cr.savepoint():
+                    result = self.env['payment.transaction'].sudo().form_feedback(
+                        json.loads(notification.payload), 'payzen'
+                    )
+            except ValidationError as e:
+                _logger.info("Payzen notification %s could not be processed: %s" % (notification.id, e.name))
+                notification.write({'state': 'error', 'state_message': e.name})
+            except Exception as e:
+                _logger.exception("Payzen notification %s could not be processed" % notification.id)
+                notification.write({'state': 'error', 'state_message': str(e)})
+            else:
+                if result:
+                    notification.write({'state': 'done'})
+                else:
+                    notification.write({
+                        'state': 'error',
+                        'state_message': _("Payzen: received data does not match the transaction"),
+                    })
+
+        return True
+
+    @api.model
+    def _cron_purge_notifications(self, days=30):
+        """Delete the notifications processed more than `days` days ago"""
+        limit_date = fields.Datetime.to_string(datetime.now() - timedelta(days=days))
+
+        self.search([('state', '=', 'done'), ('write_date', '<', limit_date)]).unlink()
+
+        return True
+
+    @api.multi
+    def action_retry(self):
+        """Set notifications in error back to pending, to be processed again by the cron"""
+        self.filtered(lambda n: n.state == 'error').write({'state': 'pending', 'state_message': False})
+
+        return True
+
+    @api.multi
+    def _payzen_is_already_applied(self):
+        """Check whether the transaction was already set in a final state from this Payzen transaction,
+        e.g. by the return URL or a previous notification
+
+        :return: True if the notification does not need to be applied
+        """
+        self.ensure_one()
+
+        if not self.reference or not self.trans_uuid:
+            return False
+
+        return bool(self.env['payment.transaction'].sudo().search_count([
+            ('reference', '=', self.reference),
+            ('acquirer_reference', '=', self.trans_uuid),
+            ('state', 'in', ['done', 'cancel', 'error']),
+        ]))
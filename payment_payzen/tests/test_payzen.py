@@ -1,5 +1,9 @@
 # coding: utf8
 
+import urllib.parse
+from unittest.mock import patch
+
+import requests
 from lxml import objectify
 
 from odoo.addons.payment.tests.common import PaymentAcquirerCommon
@@ -8,6 +12,9 @@ from odoo.tests import common
 
 from odoo.tools import mute_logger
 
+PAYZEN_SESSION_PATH = 'odoo.addons.payment_payzen.models.inherited_payment_acquirer._get_payzen_session'
+
+
 @common.post_install(True)
 class PayzenCommon(PaymentAcquirerCommon):
     def setUp(self):
@@ -60,6 +67,7 @@ class PayzenForm(PayzenCommon):
             'vads_version': 'V2',
             'vads_return_mode': 'GET',
             # 'vads_url_return': ignored
+            'vads_url_check': urllib.parse.urljoin(base_url, '/payment/payzen/ipn'),
             'vads_order_id': 'testref0',
 
             'vads_cust_id': str(self.buyer_id),
@@ -102,3 +110,354 @@ class PayzenForm(PayzenCommon):
                     form_values[form_input.get('name')]
                 )
             )
+
+    def test_01_payzen_form_save_render(self):
+        self.buyer_values.update({
+            'partner_id': self.buyer_id,
+            'type': 'form_save',
+        })
+
+        res = self.payzen.render(
+            'testref1',
+            0.01,
+            self.currency_euro.id,
+            values=self.buyer_values
+        )
+
+        tree = objectify.fromstring(res)
+        page_action = [form_input.get('value') for form_input in tree.input
+                       if form_input.get('name') == 'vads_page_action']
+        self.assertEqual(page_action, ['REGISTER_PAY'], 'payzen: alias should be registered on form_save')
+
+
+@common.post_install(True)
+class PayzenNotificationTest(PayzenCommon):
+
+    def _get_notification_data(self, reference):
+        data = {
+            'vads_site_id': self.payzen.payzen_shop_id,
+            'vads_amount': '1',
+            'vads_order_id': reference,
+            'vads_cust_id': str(self.buyer_id),
+            'vads_trans_status': 'AUTHORISED',
+            'vads_trans_uuid': 'dummy_uuid',
+            'vads_auth_result': '00',
+        }
+        data['signature'] = self.payzen.payzen_generate_digital_sign(data)
+
+        return data
+
+    def test_00_payzen_notification_processing(self):
+        transaction = self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_ipn',
+            'partner_id': self.buyer_id,
+        })
+
+        notification = self.env['payzen.notification'].payzen_stage_notification(
+            self._get_notification_data('test_ref_ipn')
+        )
+        self.assertEqual(notification.state, 'pending', 'payzen: notification should be staged')
+        self.assertEqual(transaction.state, 'draft', 'payzen: staging should not update the transaction')
+
+        self.env['payzen.notification']._cron_process_notifications()
+
+        self.assertEqual(notification.state, 'done', 'payzen: notification should be processed')
+        self.assertEqual(transaction.state, 'done', 'payzen: transaction should be validated')
+        self.assertEqual(transaction.acquirer_reference, 'dummy_uuid', 'payzen: wrong acquirer reference')
+
+    def test_01_payzen_notification_duplicate(self):
+        data = self._get_notification_data('test_ref_ipn')
+
+        notification = self.env['payzen.notification'].payzen_stage_notification(data)
+        duplicate = self.env['payzen.notification'].payzen_stage_notification(dict(data))
+
+        self.assertEqual(duplicate, notification, 'payzen: retried notification should not be staged twice')
+
+        del data['vads_trans_uuid']
+        data['signature'] = self.payzen.payzen_generate_digital_sign(data)
+        first = self.env['payzen.notification'].payzen_stage_notification(data)
+        second = self.env['payzen.notification'].payzen_stage_notification(dict(data, vads_order_id='test_ref_2'))
+
+        self.assertNotEqual(first, second, 'payzen: notifications without uuid should not be de-duplicated')
+
+    def test_02_payzen_notification_already_applied(self):
+        transaction = self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_ipn',
+            'partner_id': self.buyer_id,
+            'acquirer_reference': 'dummy_uuid',
+            'state': 'done',
+        })
+        date_validate = transaction.date_validate
+
+        notification = self.env['payzen.notification'].payzen_stage_notification(
+            self._get_notification_data('test_ref_ipn')
+        )
+        self.env['payzen.notification']._cron_process_notifications()
+
+        self.assertEqual(notification.state, 'done', 'payzen: notification should be skipped')
+        self.assertEqual(transaction.date_validate, date_validate, 'payzen: transaction should not be validated again')
+
+    @mute_logger('odoo.addons.payment.models.payment_acquirer')
+    def test_03_payzen_notification_invalid_parameters(self):
+        transaction = self.env['payment.transaction'].create({
+            'amount': 10.0,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_ipn',
+            'partner_id': self.buyer_id,
+        })
+
+        notification = self.env['payzen.notification'].payzen_stage_notification(
+            self._get_notification_data('test_ref_ipn')
+        )
+        self.env['payzen.notification']._cron_process_notifications()
+
+        self.assertEqual(notification.state, 'error', 'payzen: rejected notification should be in error')
+        self.assertEqual(transaction.state, 'draft', 'payzen: transaction should not be updated')
+
+    @mute_logger('odoo.addons.payment_payzen.models.payzen_notification')
+    def test_04_payzen_notification_bad_payload(self):
+        data = self._get_notification_data('test_ref_ipn')
+        del data['vads_order_id']
+        data['signature'] = self.payzen.payzen_generate_digital_sign(data)
+
+        bad_notification = self.env['payzen.notification'].payzen_stage_notification(data)
+        self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_ipn_2',
+            'partner_id': self.buyer_id,
+        })
+        data = self._get_notification_data('test_ref_ipn_2')
+        data['vads_trans_uuid'] = 'dummy_uuid_2'
+        data['signature'] = self.payzen.payzen_generate_digital_sign(data)
+        notification = self.env['payzen.notification'].payzen_stage_notification(data)
+
+        self.env['payzen.notification']._cron_process_notifications()
+
+        self.assertEqual(bad_notification.state, 'error', 'payzen: bad notification should be in error')
+        self.assertEqual(notification.state, 'done', 'payzen: bad notification should not block the batch')
+
+    @mute_logger('odoo.addons.payment.models.payment_acquirer')
+    def test_05_payzen_notification_retry_and_purge(self):
+        notification = self.env['payzen.notification'].payzen_stage_notification(
+            self._get_notification_data('test_ref_ipn')
+        )
+        self.env['payzen.notification']._cron_process_notifications()
+        self.assertEqual(notification.state, 'error', 'payzen: notification without transaction should be in error')
+
+        notification.action_retry()
+        self.assertEqual(notification.state, 'pending', 'payzen: retried notification should be pending')
+
+        self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_ipn',
+            'partner_id': self.buyer_id,
+        })
+        self.env['payzen.notification']._cron_process_notifications()
+        self.assertEqual(notification.state, 'done', 'payzen: retried notification should be processed')
+
+        self.env['payzen.notification']._cron_purge_notifications(days=30)
+        self.assertTrue(notification.exists(), 'payzen: recent notification should be kept')
+
+        self.env['payzen.notification']._cron_purge_notifications(days=-1)
+        self.assertFalse(notification.exists(), 'payzen: processed notification should be purged')
+
+    @mute_logger('odoo.addons.payment_payzen.models.payzen_notification')
+    def test_10_payzen_notification_bad_signature(self):
+        data = self._get_notification_data('test_ref_ipn')
+        data['signature'] = 'wrong'
+
+        with self.assertRaises(ValidationError):
+            self.env['payzen.notification'].payzen_stage_notification(data)
+
+
+@common.post_install(True)
+class PayzenTokenTest(PayzenCommon):
+
+    def test_00_payzen_form_save_token(self):
+        transaction = self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_token',
+            'partner_id': self.buyer_id,
+            'type': 'form_save',
+        })
+
+        transaction._payzen_form_validate({
+            'vads_trans_status': 'AUTHORISED',
+            'vads_trans_uuid': 'dummy_uuid',
+            'vads_identifier': 'dummy_alias',
+            'vads_identifier_status': 'CREATED',
+            'vads_card_number': '497010XXXXXX0000',
+        })
+
+        self.assertEqual(transaction.state, 'done', 'payzen: transaction should be validated')
+        self.assertEqual(transaction.payment_token_id.acquirer_ref, 'dummy_alias', 'payzen: wrong token alias')
+        self.assertEqual(transaction.payment_token_id.name, '497010XXXXXX0000', 'payzen: wrong token name')
+
+    def test_01_payzen_form_save_token_not_created(self):
+        transaction = self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_token',
+            'partner_id': self.buyer_id,
+            'type': 'form_save',
+        })
+
+        transaction._payzen_form_validate({
+            'vads_trans_status': 'AUTHORISED',
+            'vads_trans_uuid': 'dummy_uuid',
+            'vads_identifier': 'dummy_alias',
+            'vads_identifier_status': 'NOT_CREATED',
+            'vads_card_number': '497010XXXXXX0000',
+        })
+
+        self.assertEqual(transaction.state, 'done', 'payzen: transaction should be validated')
+        self.assertFalse(transaction.payment_token_id, 'payzen: alias not created should not be saved')
+
+    def _create_s2s_transaction(self):
+        token = self.env['payment.token'].create({
+            'name': '497010XXXXXX0000',
+            'partner_id': self.buyer_id,
+            'acquirer_id': self.payzen.id,
+            'acquirer_ref': 'dummy_alias',
+        })
+
+        return self.env['payment.transaction'].create({
+            'amount': 0.01,
+            'acquirer_id': self.payzen.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'test_ref_s2s',
+            'partner_id': self.buyer_id,
+            'payment_token_id': token.id,
+            'type': 'server2server',
+        })
+
+    def test_10_payzen_s2s_do_transaction(self):
+        transaction = self._create_s2s_transaction()
+
+        response = {
+            'status': 'SUCCESS',
+            'answer': {
+                'orderStatus': 'PAID',
+                'transactions': [{'uuid': 'dummy_uuid', 'detailedStatus': 'AUTHORISED'}],
+            },
+        }
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            session = get_session.return_value
+            session.post.return_value.json.return_value = response
+            result = transaction.s2s_do_transaction()
+
+            payload = session.post.call_args[1]['json']
+            self.assertEqual(payload['paymentMethodToken'], 'dummy_alias', 'payzen: wrong token sent')
+            self.assertEqual(payload['amount'], 1, 'payzen: wrong amount sent')
+
+        self.assertTrue(result, 'payzen: payment should succeed')
+        self.assertEqual(transaction.state, 'done', 'payzen: transaction should be validated')
+        self.assertEqual(transaction.acquirer_reference, 'dummy_uuid', 'payzen: wrong acquirer reference')
+
+    def test_11_payzen_s2s_do_transaction_error(self):
+        transaction = self._create_s2s_transaction()
+
+        response = {
+            'status': 'ERROR',
+            'answer': {'errorCode': 'INT_905', 'errorMessage': 'invalid payment method token'},
+        }
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            get_session.return_value.post.return_value.json.return_value = response
+            result = transaction.s2s_do_transaction()
+
+        self.assertFalse(result, 'payzen: payment should fail')
+        self.assertEqual(transaction.state, 'error', 'payzen: transaction should be in error')
+        self.assertIn('INT_905', transaction.state_message, 'payzen: error code should be reported')
+
+    def test_12_payzen_s2s_do_transaction_waiting_authorisation(self):
+        transaction = self._create_s2s_transaction()
+
+        response = {
+            'status': 'SUCCESS',
+            'answer': {
+                'orderStatus': 'RUNNING',
+                'transactions': [{'uuid': 'dummy_uuid', 'detailedStatus': 'WAITING_AUTHORISATION'}],
+            },
+        }
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            get_session.return_value.post.return_value.json.return_value = response
+            result = transaction.s2s_do_transaction()
+
+        self.assertFalse(result, 'payzen: deferred payment should not be reported as authorized')
+        self.assertEqual(transaction.state, 'pending', 'payzen: deferred payment should be pending')
+
+        response['answer']['transactions'][0]['detailedStatus'] = 'AUTHORISED'
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            get_session.return_value.post.return_value.json.return_value = response
+            self.env['payment.transaction']._cron_payzen_reconcile_pending()
+
+            url = get_session.return_value.post.call_args[0][0]
+            self.assertTrue(url.endswith('V4/Order/Get'), 'payzen: pending payment should be checked on its order')
+
+        self.assertEqual(transaction.state, 'done', 'payzen: reconciled payment should be validated')
+
+    def test_13_payzen_s2s_do_transaction_without_token(self):
+        transaction = self._create_s2s_transaction()
+        transaction.payment_token_id = False
+
+        with self.assertRaises(ValidationError):
+            transaction.s2s_do_transaction()
+
+    @mute_logger('odoo.addons.payment_payzen.models.inherited_payment_acquirer')
+    def test_14_payzen_s2s_do_transaction_timeout(self):
+        transaction = self._create_s2s_transaction()
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            get_session.return_value.post.side_effect = requests.exceptions.Timeout()
+            result = transaction.s2s_do_transaction()
+
+        self.assertFalse(result, 'payzen: payment without answer should not be reported as authorized')
+        self.assertEqual(transaction.state, 'pending', 'payzen: payment without answer should be reconciled')
+        self.assertTrue(transaction.state_message, 'payzen: timeout should be reported')
+
+    @mute_logger('odoo.addons.payment_payzen.models.inherited_payment_acquirer')
+    def test_15_payzen_s2s_do_transaction_connection_error(self):
+        transaction = self._create_s2s_transaction()
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            get_session.return_value.post.side_effect = requests.exceptions.ConnectionError()
+            result = transaction.s2s_do_transaction()
+
+        self.assertFalse(result, 'payzen: payment should fail')
+        self.assertEqual(transaction.state, 'error', 'payzen: transaction should be in error')
+
+    def test_16_payzen_s2s_do_transaction_non_admin(self):
+        transaction = self._create_s2s_transaction()
+
+        response = {
+            'status': 'SUCCESS',
+            'answer': {
+                'orderStatus': 'PAID',
+                'transactions': [{'uuid': 'dummy_uuid', 'detailedStatus': 'AUTHORISED'}],
+            },
+        }
+
+        with patch(PAYZEN_SESSION_PATH) as get_session:
+            get_session.return_value.post.return_value.json.return_value = response
+            result = transaction.sudo(self.env.ref('base.user_demo')).s2s_do_transaction()
+
+        self.assertTrue(result, 'payzen: payment should not require access to the credentials')
+        self.assertEqual(transaction.state, 'done', 'payzen: transaction should be validated')